@@ -0,0 +1 @@
+"""Control LMS based on a connected bluetooth audio source."""
@@ -0,0 +1,520 @@
+"""Python agent to interface between a bluetooth audio source and LMS."""
+
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from importlib.resources import files
+
+import aiohttp
+from dbus_fast import BusType, Message, MessageType
+from dbus_fast.aio import MessageBus
+from dbus_fast.errors import DBusError
+from dbus_fast.introspection import Node
+from pysqueezebox import Server
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logging.basicConfig(level=logging.WARN)
+logger = logging.getLogger(__name__)
+logging.getLogger("pysqueezebox").setLevel(logging.WARN)
+logger.debug("Starting lms-bluetooth-control")
+
+SERVER = "127.0.0.1"
+DEFAULT_PLAYER = "Main Cabin"
+TRACK_INFO_JSON = "/tmp/bluetooth_metadata.json"
+# LMS is local, so a few kept-alive connections are plenty
+LMS_CONNECTION_LIMIT = 4
+LMS_TIMEOUT = 5
+# seconds between LMS status polls while waiting for a player power change
+POWER_POLL_INTERVAL = 60
+
+# window in seconds for collapsing bursts of PropertiesChanged signals
+PROPERTIES_CHANGED_DELAY = 0.05
+
+SERVICE_NAME = "org.bluez"
+PLAYER_IFACE = SERVICE_NAME + ".MediaPlayer1"
+OBJECT_MANAGER_IFACE = "org.freedesktop.DBus.ObjectManager"
+PROPERTIES_IFACE = "org.freedesktop.DBus.Properties"
+AGENT_MANAGER_IFACE = "org.bluez.AgentManager1"
+
+PACKAGE_DATA = files("lms_bluetooth_control")
+
+# parse the introspection data once and share it between proxy objects
+OBJECT_MANAGER_INTROSPECTION = Node.parse(
+    PACKAGE_DATA.joinpath("objectmanager_introspection.xml").read_text(encoding="utf-8")
+)
+MEDIA_PLAYER1_INTROSPECTION = Node.parse(
+    PACKAGE_DATA.joinpath("mediaplayer1_introspection.xml").read_text(encoding="utf-8")
+)
+
+
+def is_playing(mode):
+    """Return whether an LMS player mode is playing."""
+    return mode == "play"
+
+
+def is_not_playing(mode):
+    """Return whether an LMS player mode is paused or stopped."""
+    return mode != "play"
+
+
+class BluetoothPlayer:
+    """Represent a particular bluetooth player and accompanying Squeezebox player object."""
+
+    __slots__ = (
+        "bus",
+        "path",
+        "lms_player",
+        "mediaplayer1_interface",
+        "connected",
+        "lms_pause_watch",
+        "lms_play_watch",
+        "remote_mac_address",
+        "manager",
+        "_bt_url",
+        "_objects",
+        "_pending_changed",
+        "_pending_task",
+        "_last_track",
+        "_match_rule",
+        "_bluez_owner",
+    )
+
+    def __init__(self, bus, player):
+        """Initialize BluetoothPlayer.
+
+        :param MessageBus bus:
+            The system DBus.
+
+        :param Player player:
+            The LMS player to control.
+        """
+        self.bus = bus
+        self.path = None
+        self.lms_player = player
+        self.mediaplayer1_interface = None
+        self.connected = False
+        self.lms_pause_watch = None
+        self.lms_play_watch = None
+        self.remote_mac_address = None
+        self._bt_url = None
+        self._objects = {}
+        self._pending_changed = {}
+        self._pending_task = None
+        self._last_track = None
+        self._match_rule = None
+        self._bluez_owner = None
+
+        dbus_object = bus.get_proxy_object(
+            SERVICE_NAME, "/", OBJECT_MANAGER_INTROSPECTION
+        )
+
+        self.manager = dbus_object.get_interface(OBJECT_MANAGER_IFACE)
+        self.manager.on_interfaces_added(self.interfaces_added)
+        self.manager.on_interfaces_removed(self.interfaces_removed)
+        bus.add_message_handler(self.message_handler)
+
+    async def find_player(self):
+        """Look for device associated with PLAYER_IFACE.
+
+        The full object tree is fetched once; afterwards it is kept up to date
+        from the InterfacesAdded and InterfacesRemoved signals.
+        """
+        objects = await self.manager.call_get_managed_objects()
+        # merge rather than replace, keeping anything added while we waited
+        for path, values in objects.items():
+            self._objects.setdefault(path, {}).update(values)
+
+        player_path = self.first_player_path()
+        if player_path:
+            await self.bind_player(player_path)
+        else:
+            logger.debug("Could not find player.")
+
+    def first_player_path(self):
+        """Return the path of the first known media player, or None."""
+        for path, values in self._objects.items():
+            if PLAYER_IFACE in values:
+                return path
+        return None
+
+    async def bind_player(self, player_path):
+        """Attach to the media player at player_path and sync LMS with it."""
+        logger.debug("Found player on path %s", player_path)
+        # only accept signals from the process currently owning org.bluez
+        owner = await self.call_bus_daemon("GetNameOwner", SERVICE_NAME)
+        if not owner:
+            logger.warning(
+                "Could not resolve owner of %s, not binding player %s",
+                SERVICE_NAME,
+                player_path,
+            )
+            return
+        self._bluez_owner = owner[0]
+        self.cleanup_watches()
+        self.path = player_path
+        self.connected = True
+        bluetooth_player_object = self.bus.get_proxy_object(
+            SERVICE_NAME, player_path, MEDIA_PLAYER1_INTROSPECTION
+        )
+        self.mediaplayer1_interface = bluetooth_player_object.get_interface(
+            PLAYER_IFACE
+        )
+        self.remote_mac_address = None
+        self._bt_url = None
+        try:
+            device_path = await self.mediaplayer1_interface.get_device()
+            mac_address = device_path.rsplit("dev_", 1)[1].replace("_", ":")
+        except (DBusError, IndexError):
+            logger.warning("Could not read device address of player %s", player_path)
+        else:
+            self.remote_mac_address = mac_address
+            self._bt_url = f"wavin:bluealsa:DEV={mac_address}"
+
+        # let the bus daemon drop property changes for other interfaces
+        await self.update_match(
+            f"type='signal',sender='{SERVICE_NAME}',interface='{PROPERTIES_IFACE}',"
+            f"member='PropertiesChanged',path='{player_path}',arg0='{PLAYER_IFACE}'"
+        )
+
+        try:
+            if await self.mediaplayer1_interface.get_status() == "playing":
+                return await self.lms_play()
+        except DBusError:
+            logger.debug("No status property found, presumably player not playing.")
+
+        await self.lms_player.async_update()
+        if self.lms_player.url and "wavin:bluealsa" in self.lms_player.url:
+            # source already set to bluetooth, so let's watch it's status
+            if self.lms_player.mode == "play":
+                await self.pause_watch()
+            else:
+                await self.play_watch()
+
+    async def set_lms_player(self, player):
+        """Control a different LMS player and sync it with the bluetooth player."""
+        self.cleanup_watches()
+        self.lms_player = player
+        if self.path:
+            await self.bind_player(self.path)
+
+    def cleanup_watches(self):
+        """Cancel any pending LMS watches so they are not left dangling."""
+        for watch in (self.lms_pause_watch, self.lms_play_watch):
+            if watch is not None and not watch.done():
+                watch.cancel()
+        self.lms_pause_watch = None
+        self.lms_play_watch = None
+
+    async def pause_watch(self):
+        """Wait for the LMS player to pause or stop."""
+        if self.lms_pause_watch is None or self.lms_pause_watch.done():
+            logger.debug("Setting LMS pause watch.")
+            watch = self.lms_pause_watch = self.lms_player.create_property_future(
+                "mode", is_not_playing
+            )
+            try:
+                await watch
+            except asyncio.CancelledError:
+                # only swallow the cancellation if we dropped this watch ourselves
+                if self.lms_pause_watch is watch:
+                    raise
+                logger.debug("LMS pause watch cancelled.")
+                return
+            logger.debug("LMS player paused.")
+            await self.pause_if_playing()
+        else:
+            logger.debug("Pause watch already set, player is %s", self.lms_player.mode)
+
+    async def play_watch(self):
+        """Wait for the LMS player to play."""
+        if self.lms_play_watch is None or self.lms_play_watch.done():
+            logger.debug("Setting LMS play watch.")
+            watch = self.lms_play_watch = self.lms_player.create_property_future(
+                "mode", is_playing
+            )
+            try:
+                await watch
+            except asyncio.CancelledError:
+                # only swallow the cancellation if we dropped this watch ourselves
+                if self.lms_play_watch is watch:
+                    raise
+                logger.debug("LMS play watch cancelled.")
+                return
+            logger.debug("LMS player playing.")
+            await self.play_if_paused()
+        else:
+            logger.debug("Play watch already set, player is %s", self.lms_player.mode)
+
+    # pylint: disable=unused-argument
+    def interfaces_added(self, object_added, interfaces_and_paths):
+        """Monitor for new media player devices."""
+        logger.debug("Interfaces added: %s", interfaces_and_paths)
+        self._objects.setdefault(object_added, {}).update(interfaces_and_paths)
+        if PLAYER_IFACE in interfaces_and_paths:
+            asyncio.create_task(self.bind_player(object_added))
+        else:
+            logger.debug("Not a media player.")
+
+    def interfaces_removed(self, object_removed, interfaces):
+        """Forget removed interfaces and drop the media player if it went away."""
+        logger.debug("Interfaces removed from %s: %s", object_removed, interfaces)
+        values = self._objects.get(object_removed)
+        if values is not None:
+            for interface in interfaces:
+                values.pop(interface, None)
+            if not values:
+                del self._objects[object_removed]
+        if object_removed == self.path and PLAYER_IFACE in interfaces:
+            logger.debug("Player on path %s removed", object_removed)
+            self.cleanup_watches()
+            asyncio.create_task(self.update_match(None))
+            self.path = None
+            self.connected = False
+            self.mediaplayer1_interface = None
+            # drop changes the player sent just before it went away
+            if self._pending_task is not None:
+                self._pending_task.cancel()
+                self._pending_task = None
+            self._pending_changed = {}
+            self.remote_mac_address = None
+            self._bt_url = None
+            player_path = self.first_player_path()
+            if player_path:
+                asyncio.create_task(self.bind_player(player_path))
+
+    async def call_bus_daemon(self, member, argument):
+        """Call a bus daemon method taking one string, returning the reply body.
+
+        Return None if the call failed.
+        """
+        reply = await self.bus.call(
+            Message(
+                destination="org.freedesktop.DBus",
+                path="/org/freedesktop/DBus",
+                interface="org.freedesktop.DBus",
+                member=member,
+                signature="s",
+                body=[argument],
+            )
+        )
+        if reply.message_type == MessageType.ERROR:
+            logger.warning("%s failed for %s: %s", member, argument, reply.body)
+            return None
+        return reply.body
+
+    async def update_match(self, match_rule):
+        """Replace the PropertiesChanged match rule, or just remove it if None."""
+        old_rule, self._match_rule = self._match_rule, match_rule
+        for member, rule in (("RemoveMatch", old_rule), ("AddMatch", match_rule)):
+            if rule is not None:
+                await self.call_bus_daemon(member, rule)
+
+    def message_handler(self, message):
+        """Dispatch PropertiesChanged signals for the bound media player."""
+        if (
+            message.message_type == MessageType.SIGNAL
+            and message.member == "PropertiesChanged"
+            and message.interface == PROPERTIES_IFACE
+            and message.sender is not None
+            and message.sender == self._bluez_owner
+            and message.path == self.path
+            and message.body
+            and message.body[0] == PLAYER_IFACE
+        ):
+            self.properties_changed(*message.body)
+
+    # pylint: disable=unused-argument
+    def properties_changed(self, interface, changed, invalidated):
+        """Schedule the property change coroutine, coalescing bursts of signals."""
+        self._pending_changed.update(changed)
+        if self._pending_task is None:
+            self._pending_task = asyncio.create_task(self.flush_properties_changed())
+
+    async def flush_properties_changed(self):
+        """Handle all property changes received during the coalescing window."""
+        await asyncio.sleep(PROPERTIES_CHANGED_DELAY)
+        changed, self._pending_changed = self._pending_changed, {}
+        self._pending_task = None
+        await self.async_properties_changed(changed)
+
+    async def async_properties_changed(self, changed):
+        """Handle relevant property change signals."""
+        # write track title, album, and artist to JSON file
+        if "Track" in changed:
+            track = changed["Track"].value
+            track_values = {key: value.value for key, value in track.items()}
+            if track_values != self._last_track:
+                logger.info("Track changed to %s", track_values)
+                # write track info to JSON file off the event loop
+                await asyncio.to_thread(write_track_info, track_values)
+                self._last_track = track_values
+
+        if "Status" in changed:
+            status = changed["Status"].value
+            logger.debug("Bluetooth player changed to status %s", status)
+            # lms_play and lms_pause then wait on an LMS watch, so run them
+            # separately rather than holding up this batch of changes
+            if status == "paused":
+                asyncio.create_task(self.lms_pause())
+            elif status == "playing":
+                asyncio.create_task(self.lms_play())
+
+    async def lms_play(self):
+        """Start LMS player and pause watch."""
+        if self.mediaplayer1_interface is None:
+            logger.debug("Not starting LMS player, bluetooth player is gone.")
+            return
+        if self._bt_url is None:
+            logger.warning("Not starting LMS player, bluetooth device address unknown.")
+            return
+        if self.lms_play_watch and not self.lms_play_watch.done():
+            logger.debug("Starting player and watching for pause.")
+            self.lms_play_watch.cancel()
+            self.lms_play_watch = None
+        await self.lms_player.async_load_url(self._bt_url)
+        await self.lms_player.async_play()
+        await self.pause_watch()
+
+    async def lms_pause(self):
+        """Pause the LMS player and stop watching for a pause."""
+        if self.mediaplayer1_interface is None:
+            logger.debug("Not pausing LMS player, bluetooth player is gone.")
+            return
+        if self.lms_pause_watch and not self.lms_pause_watch.done():
+            logger.debug("Pausing player and watching for pause.")
+            self.lms_pause_watch.cancel()
+            self.lms_pause_watch = None
+        await self.lms_player.async_pause()
+        await self.play_watch()
+
+    async def pause_if_playing(self):
+        """Confirm LMS paused and send the bluetooth pause command if bluetooth playing."""
+        await self.lms_player.async_update()
+        if self.lms_player.mode != "play":
+            if await self.mediaplayer1_interface.get_status() == "playing":
+                logger.debug("Sending pause command to bluetooth player.")
+                await self.mediaplayer1_interface.call_pause()
+            else:
+                logger.debug(
+                    "Not sending pause command because bluetooth player is paused."
+                )
+        else:
+            logger.debug("Not pausing bluetooth player because LMS is playing.")
+
+    async def play_if_paused(self):
+        """Confirm LMS playing and send the bluetooth play command if bluetooth paused."""
+        await self.lms_player.async_update()
+        if self.lms_player.mode == "play":
+            if await self.mediaplayer1_interface.get_status() == "paused":
+                logger.debug("Sending play command to bluetooth player.")
+                await self.mediaplayer1_interface.call_play()
+            else:
+                logger.debug(
+                    "Not sending play command because bluetooth player is playing."
+                )
+        else:
+            logger.debug("Not playing bluetooth player because LMS is not playing.")
+
+
+def write_track_info(track_values):
+    """Atomically replace TRACK_INFO_JSON so readers never see a partial file."""
+    # each write gets its own temporary file so overlapping writes can't mix
+    tmp_file = tempfile.NamedTemporaryFile(
+        "w",
+        encoding="utf-8",
+        dir=os.path.dirname(TRACK_INFO_JSON),
+        suffix=".tmp",
+        delete=False,
+    )
+    try:
+        with tmp_file:
+            json.dump(track_values, tmp_file)
+        # temporary files are private, but other readers need the metadata
+        os.chmod(tmp_file.name, 0o644)
+        os.replace(tmp_file.name, TRACK_INFO_JSON)
+    except BaseException:
+        os.unlink(tmp_file.name)
+        raise
+
+
+async def find_active_player(lms):
+    """Find an active LMS player, if there is one. Otherwise use default player."""
+    assert lms is not None
+    players = await lms.async_get_players()
+    if not players:
+        logger.warning("No Squeezebox players found on server %s", lms)
+        return None
+    await asyncio.gather(*(player.async_update() for player in players))
+    player = next((player for player in players if player.power), None)
+    if player:
+        logger.info("Found active Squeezebox player %s", player.name)
+        return player
+    logger.info("Using default Squeezebox player %s", DEFAULT_PLAYER)
+    return await lms.async_get_player(DEFAULT_PLAYER)
+
+
+async def wait_for_power(player, power):
+    """Wait for an LMS player's power state to become power.
+
+    pysqueezebox only polls LMS for this, so poll slowly. A failed status query
+    stops pysqueezebox's polling, so re-arm the watch if it has not resolved
+    within two intervals.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(
+                player.create_property_future(
+                    "power", lambda value: value is power, interval=POWER_POLL_INTERVAL
+                ),
+                POWER_POLL_INTERVAL * 2,
+            )
+            return
+        except asyncio.TimeoutError:
+            logger.debug("Re-arming power watch for player %s", player.name)
+
+
+async def main():
+    """Monitor DBus for bluetooth players."""
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+
+    connector = aiohttp.TCPConnector(limit=LMS_CONNECTION_LIMIT, ttl_dns_cache=None)
+    timeout = aiohttp.ClientTimeout(total=LMS_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        lms = Server(session, SERVER)
+        player = await find_active_player(lms)
+        assert player is not None
+
+        bluetooth_player = BluetoothPlayer(bus, player)
+        # syncing waits on LMS watches, so keep it off the power loop
+        asyncio.create_task(bluetooth_player.find_player())
+
+        while True:
+            # wait until the player we control is powered off
+            await wait_for_power(player, False)
+            logger.info("Player %s powered off", player.name)
+            new_player = await find_active_player(lms) or player
+            if new_player is not player:
+                player = new_player
+                asyncio.create_task(bluetooth_player.set_lms_player(player))
+            if not player.power:
+                # fell back to an idle player, so wait for it to be powered on
+                await wait_for_power(player, True)
+
+
+def main_sync():
+    """Run the agent until it is stopped."""
+    # uvloop.run() only exists from uvloop 0.18
+    if uvloop is not None and hasattr(uvloop, "run"):
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
+
+
+if __name__ == "__main__":
+    main_sync()